@@ -10,37 +10,503 @@ part of mavPySim
 """
 import sys
 sys.path.append('..')
+import math
 import numpy as np
+from numba import njit, prange
 
 # load message types
 from message_types.msg_state import MsgState
 
 import parameters.aerosonde_parameters as MAV
-from tools.rotations import Euler2Quaternion, Quaternion2Rotation, Quaternion2Euler
+from tools.rotations import Euler2Quaternion
+
+
+def _delta_to_array(delta):
+    """
+    packs a MsgDelta into a flat float64 vector, in the MsgDelta.to_array order
+    (elevator, aileron, rudder, throttle)
+    """
+    return np.array([delta.elevator, delta.aileron, delta.rudder, delta.throttle], dtype=np.float64)
+
+
+@njit(cache=True, fastmath=True, inline='always')
+def _quat_rotate(e0, e1, e2, e3, vx, vy, vz):
+    """
+    rotates the vector (vx, vy, vz) by the unit quaternion (e0, e1, e2, e3),
+    i.e. returns Quaternion2Rotation(e) @ v without building the rotation matrix
+    """
+    out_x = (e0*e0 + e1*e1 - e2*e2 - e3*e3)*vx + 2.0*(e1*e2 - e0*e3)*vy + 2.0*(e1*e3 + e0*e2)*vz
+    out_y = 2.0*(e1*e2 + e0*e3)*vx + (e0*e0 - e1*e1 + e2*e2 - e3*e3)*vy + 2.0*(e2*e3 - e0*e1)*vz
+    out_z = 2.0*(e1*e3 - e0*e2)*vx + 2.0*(e2*e3 + e0*e1)*vy + (e0*e0 - e1*e1 - e2*e2 + e3*e3)*vz
+    return out_x, out_y, out_z
+
+
+@njit(cache=True, fastmath=True, inline='always')
+def _quat_to_euler(e0, e1, e2, e3):
+    """
+    converts the unit quaternion (e0, e1, e2, e3) to euler angles (phi, theta, psi),
+    as Quaternion2Euler does for a quaternion array
+    """
+    phi = math.atan2(2.0*(e0*e1 + e2*e3), e0*e0 + e3*e3 - e1*e1 - e2*e2)
+    theta = math.asin(2.0*(e0*e2 - e1*e3))
+    psi = math.atan2(2.0*(e0*e3 + e1*e2), e0*e0 + e1*e1 - e2*e2 - e3*e3)
+    return phi, theta, psi
+
+
+@njit(cache=True, fastmath=True)
+def _derivatives_kernel(state, forces_moments, params, x_dot):
+    """
+    for the dynamics xdot = f(x, u), writes f(x, u) into x_dot
+    :param state: flat 13 state [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
+    :param forces_moments: flat 6 vector [fx, fy, fz, l, m, n]
+    :param params: flat vector [mass, Jy, gamma1, ..., gamma8]
+    :param x_dot: flat 13 output vector of state derivatives
+    """
+    # extract the states
+    u = state[3]
+    v = state[4]
+    w = state[5]
+    e0 = state[6]
+    e1 = state[7]
+    e2 = state[8]
+    e3 = state[9]
+    p = state[10]
+    q = state[11]
+    r = state[12]
+    #   extract forces/moments
+    fx = forces_moments[0]
+    fy = forces_moments[1]
+    fz = forces_moments[2]
+    l = forces_moments[3]
+    m = forces_moments[4]
+    n = forces_moments[5]
+    #   extract parameters
+    mass = params[0]
+    Jy = params[1]
+    gamma1 = params[2]
+    gamma2 = params[3]
+    gamma3 = params[4]
+    gamma4 = params[5]
+    gamma5 = params[6]
+    gamma6 = params[7]
+    gamma7 = params[8]
+    gamma8 = params[9]
+
+    # position kinematics (body velocity rotated into the inertial frame)
+    x_dot[0], x_dot[1], x_dot[2] = _quat_rotate(e0, e1, e2, e3, u, v, w)
+
+    # position dynamics
+    x_dot[3] = (r*v - q*w) + fx/mass
+    x_dot[4] = (p*w - r*u) + fy/mass
+    x_dot[5] = (q*u - p*v) + fz/mass
+
+    # rotational kinematics
+    x_dot[6] = 0.5*(-p*e1 - q*e2 - r*e3)
+    x_dot[7] = 0.5*(p*e0 + r*e2 - q*e3)
+    x_dot[8] = 0.5*(q*e0 - r*e1 + p*e3)
+    x_dot[9] = 0.5*(r*e0 + q*e1 - p*e2)
+
+    # rotatonal dynamics
+    x_dot[10] = gamma1*p*q - gamma2*q*r + gamma3*l + gamma4*n
+    x_dot[11] = gamma5*p*r - gamma6*(p*p - r*r) + m/Jy
+    x_dot[12] = gamma7*p*q - gamma1*q*r + gamma4*l + gamma8*n
+
+
+@njit(cache=True, fastmath=True)
+def _rk4_step(state, forces_moments, dt, params, work):
+    """
+    advances the flat 13 state in place by one Runge-Kutta RK4 step of size dt,
+    holding forces_moments constant over the step, and renormalizes the quaternion
+    work is a reusable (5, 13) scratch buffer for the stages
+    """
+    k1 = work[0]
+    k2 = work[1]
+    k3 = work[2]
+    k4 = work[3]
+    tmp = work[4]
+    _derivatives_kernel(state, forces_moments, params, k1)
+    for i in range(13):
+        tmp[i] = state[i] + 0.5*dt*k1[i]
+    _derivatives_kernel(tmp, forces_moments, params, k2)
+    for i in range(13):
+        tmp[i] = state[i] + 0.5*dt*k2[i]
+    _derivatives_kernel(tmp, forces_moments, params, k3)
+    for i in range(13):
+        tmp[i] = state[i] + dt*k3[i]
+    _derivatives_kernel(tmp, forces_moments, params, k4)
+    for i in range(13):
+        state[i] += dt*(k1[i] + 2.0*k2[i] + 2.0*k3[i] + k4[i])/6.0
+
+    # normalize the quaternion (one reciprocal square root and four multiplies, no branches)
+    norm2 = state[6]*state[6] + state[7]*state[7] + state[8]*state[8] + state[9]*state[9]
+    inv = 1.0/math.sqrt(norm2)
+    state[6] *= inv
+    state[7] *= inv
+    state[8] *= inv
+    state[9] *= inv
+
+
+@njit(cache=True, fastmath=True)
+def _update_velocity_kernel(state, wind):
+    """
+    computes the airspeed, angle of attack and sideslip angle
+    :param state: flat 13 state [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
+    :param wind: flat 6 vector, steady wind in the inertial frame followed by gust in the body frame
+    :return: (Va, alpha, beta)
+    """
+    # convert wind vector from world to body frame and add gust
+    wx, wy, wz = _quat_rotate(state[6], state[7], state[8], state[9], wind[0], wind[1], wind[2])
+    # velocity vector relative to the airmass
+    ur = state[3] - (wx + wind[3])
+    vr = state[4] - (wy + wind[4])
+    wr = state[5] - (wz + wind[5])
+    # compute airspeed
+    Va = math.sqrt(ur*ur + vr*vr + wr*wr)
+    # compute angle of attack
+    alpha = math.atan2(wr, ur)
+    # compute sideslip angle
+    if Va > 0:
+        beta = math.asin(vr/Va)
+    else:
+        beta = 0.0
+    return Va, alpha, beta
+
+
+def _mav_params():
+    """
+    packs the airframe constants used by the compiled kernels into a flat float64 vector
+    (passed at run time rather than compiled in, so one cached build of the kernels
+    serves any airframe defined by a parameter file)
+    """
+    return np.array([MAV.mass,           # (0)
+                     MAV.Jy,             # (1)
+                     MAV.gamma1,         # (2)
+                     MAV.gamma2,         # (3)
+                     MAV.gamma3,         # (4)
+                     MAV.gamma4,         # (5)
+                     MAV.gamma5,         # (6)
+                     MAV.gamma6,         # (7)
+                     MAV.gamma7,         # (8)
+                     MAV.gamma8,         # (9)
+                     MAV.gravity,        # (10)
+                     MAV.rho,            # (11)
+                     MAV.S_wing,         # (12)
+                     MAV.b,              # (13)
+                     MAV.c,              # (14)
+                     MAV.e,              # (15)
+                     MAV.AR,             # (16)
+                     MAV.M,              # (17)
+                     MAV.alpha0,         # (18)
+                     MAV.C_L_0,          # (19)
+                     MAV.C_L_alpha,      # (20)
+                     MAV.C_L_q,          # (21)
+                     MAV.C_L_delta_e,    # (22)
+                     MAV.C_D_p,          # (23)
+                     MAV.C_D_q,          # (24)
+                     MAV.C_D_delta_e,    # (25)
+                     MAV.C_m_0,          # (26)
+                     MAV.C_m_alpha,      # (27)
+                     MAV.C_m_q,          # (28)
+                     MAV.C_m_delta_e,    # (29)
+                     MAV.C_Y_0,          # (30)
+                     MAV.C_Y_beta,       # (31)
+                     MAV.C_Y_p,          # (32)
+                     MAV.C_Y_r,          # (33)
+                     MAV.C_Y_delta_a,    # (34)
+                     MAV.C_Y_delta_r,    # (35)
+                     MAV.C_ell_0,        # (36)
+                     MAV.C_ell_beta,     # (37)
+                     MAV.C_ell_p,        # (38)
+                     MAV.C_ell_delta_a,  # (39)
+                     MAV.C_ell_delta_r,  # (40)
+                     MAV.C_n_0,          # (41)
+                     MAV.C_n_beta,       # (42)
+                     MAV.C_n_p,          # (43)
+                     MAV.C_n_delta_a,    # (44)
+                     MAV.C_n_delta_r,    # (45)
+                     MAV.V_max,          # (46)
+                     MAV.D_prop,         # (47)
+                     MAV.D_prop**3,      # (48)
+                     MAV.D_prop**4,      # (49)
+                     MAV.D_prop**5,      # (50)
+                     MAV.KQ,             # (51)
+                     MAV.R_motor,        # (52)
+                     MAV.i0,             # (53)
+                     MAV.C_Q0,           # (54)
+                     MAV.C_Q1,           # (55)
+                     MAV.C_Q2,           # (56)
+                     MAV.C_T0,           # (57)
+                     MAV.C_T1,           # (58)
+                     MAV.C_T2],          # (59)
+                    dtype=np.float64)
+
+
+_INV_4PI2 = 1.0/(2.0*np.pi)**2
+
+# calm air, used when no wind vector is supplied
+_NO_WIND = np.zeros(6)
+
+
+@njit(cache=True, fastmath=True, inline='always')
+def _motor_thrust_torque_kernel(Va, delta_t, params):
+    """
+    compute thrust and torque due to propeller  (See addendum by McLain)
+    """
+    rho = params[11]
+    V_max = params[46]
+    D_prop = params[47]
+    D3 = params[48]
+    D4 = params[49]
+    D5 = params[50]
+    KQ = params[51]
+    R_motor = params[52]
+    i0 = params[53]
+    C_Q0 = params[54]
+    C_Q1 = params[55]
+    C_Q2 = params[56]
+    C_T0 = params[57]
+    C_T1 = params[58]
+    C_T2 = params[59]
+
+    # map delta_t throttle command(0 to 1) into motor input voltage
+    V_in = V_max * delta_t
+
+    # quadratic formula to solve for motor speed
+    a = C_Q0 * rho * D5 * _INV_4PI2
+    b = (C_Q1 * rho * D4 * Va * _INV_4PI2) + (KQ*KQ)/R_motor
+    c = (C_Q2 * rho * D3 * Va*Va) - (KQ/R_motor) + KQ*i0
+
+    # operating propeller speed
+    Omega_op = (-b + math.sqrt(b*b - 4*a*c)) / (2.*a)  # rad/sec
+    # compute advance ratio
+    J_op = 2 * math.pi * Va / (Omega_op * D_prop)
+
+    # thrust and torque coefficients
+    C_T = C_T2 * J_op*J_op + C_T1 * J_op + C_T0
+    C_Q = C_Q2 * J_op*J_op + C_Q1 * J_op + C_Q0
+
+    n = Omega_op / (2 * math.pi)  # rev/sec
+
+    # thrust and torque due to propeller
+    thrust_prop = rho * n*n * D4 * C_T
+    torque_prop = rho * n*n * D5 * C_Q
+    return thrust_prop, torque_prop
+
+
+@njit(cache=True, fastmath=True)
+def _forces_moments_kernel(state, delta, Va, alpha, beta, params):
+    """
+    return the forces on the UAV based on the state, wind, and control surfaces
+    :param state: flat 13 state [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
+    :param delta: flat 4 vector (delta_e, delta_a, delta_r, delta_t), see _delta_to_array
+    :param Va, alpha, beta: airspeed and aerodynamic angles, see _update_velocity_kernel
+    :param params: airframe constants, see _mav_params
+    :return: forces and moments on the UAV (fx, fy, fz, Mx, My, Mz)
+    """
+    e0 = state[6]
+    e1 = state[7]
+    e2 = state[8]
+    e3 = state[9]
+    p = state[10]
+    q = state[11]
+    r = state[12]
+    de = delta[0]
+    da = delta[1]
+    dr = delta[2]
+    dt = delta[3]
+
+    mass = params[0]
+    gravity = params[10]
+    rho = params[11]
+    S = params[12]
+    b = params[13]
+    c = params[14]
+    e = params[15]
+    AR = params[16]
+    M = params[17]
+    alpha0 = params[18]
+    C_L_0 = params[19]
+    C_L_alpha = params[20]
+    C_L_q = params[21]
+    C_L_delta_e = params[22]
+    C_D_p = params[23]
+    C_D_q = params[24]
+    C_D_delta_e = params[25]
+    C_m_0 = params[26]
+    C_m_alpha = params[27]
+    C_m_q = params[28]
+    C_m_delta_e = params[29]
+    C_Y_0 = params[30]
+    C_Y_beta = params[31]
+    C_Y_p = params[32]
+    C_Y_r = params[33]
+    C_Y_delta_a = params[34]
+    C_Y_delta_r = params[35]
+    C_ell_0 = params[36]
+    C_ell_beta = params[37]
+    C_ell_p = params[38]
+    C_ell_delta_a = params[39]
+    C_ell_delta_r = params[40]
+    C_n_0 = params[41]
+    C_n_beta = params[42]
+    C_n_p = params[43]
+    C_n_delta_a = params[44]
+    C_n_delta_r = params[45]
+
+    inv_Va = 1.0/Va if Va > 0 else 0.0
+    half_c_Va = 0.5*c*inv_Va
+    half_b_Va = 0.5*b*inv_Va
+    sa = math.sin(alpha)
+    ca = math.cos(alpha)
+    # sign(0) differs from np.sign, but the flat plate term vanishes with sin(alpha) there
+    sign_alpha = math.copysign(1.0, alpha)
+
+    # Sigma --> Blending Function
+    e_minus = math.exp(-M*(alpha - alpha0))
+    e_plus = math.exp(M*(alpha + alpha0))
+    sigma = (1.0 + e_minus + e_plus) / ((1.0 + e_minus) * (1.0 + e_plus))
+
+    # compute gravitaional forces in the body frame
+    # (inertial [0, 0, mg] rotated into the body frame, i.e. mg times the last row of Rb_i)
+    mg = mass*gravity
+    fg_x = 2.0*(e1*e3 - e0*e2)*mg
+    fg_y = 2.0*(e2*e3 + e0*e1)*mg
+    fg_z = (e0*e0 - e1*e1 - e2*e2 + e3*e3)*mg
+
+    # compute Lift and Drag coefficients
+    CL_linear = C_L_0 + C_L_alpha*alpha
+    CL = ((1 - sigma)*CL_linear) + ((sigma)*2*sign_alpha*(sa*sa)*ca)
+    CD = C_D_p + (CL_linear*CL_linear)/(math.pi*e*AR)
+
+    # compute Lift and Drag Forces
+    qS = 0.5*rho*Va*Va*S        # dynamic pressure --> force term (*S) for lift/drag
+    F_lift = qS*(CL * (C_L_q*half_c_Va*q) + C_L_delta_e*de)
+    F_drag = qS*(CD * (C_D_q*half_c_Va*q) + C_D_delta_e*de)
+
+    #compute propeller thrust and torque
+    thrust_prop, torque_prop = _motor_thrust_torque_kernel(Va, dt, params)
+
+    # compute longitudinal forces in body frame
+    fx = fg_x - F_drag*ca + F_lift*sa
+    fz = fg_z - F_drag*sa - F_lift*ca
+
+    # compute lateral forces in body frame
+    fy = fg_y + qS * (C_Y_0 + C_Y_beta*beta + C_Y_p*half_b_Va*p + C_Y_r*half_b_Va*r + C_Y_delta_a*da + C_Y_delta_r*dr)
+
+    # compute logitudinal torque in body frame
+    My = qS*c*(C_m_0 + (C_m_alpha*alpha) + (C_m_q*half_c_Va*q) + (C_m_delta_e*de))
+
+    # compute lateral torques in body frame
+    Mx = qS*b*(C_ell_0 + C_ell_beta*beta + C_ell_p*half_b_Va*r + C_ell_delta_a*da + C_ell_delta_r*dr)
+    Mz = qS*b*(C_n_0 + C_n_beta*beta + C_n_p*half_b_Va*r + C_n_delta_a*da + C_n_delta_r*dr)
+    return fx, fy, fz, Mx, My, Mz
+
+
+@njit(cache=True, fastmath=True)
+def _simulate_one_tick(state, delta, wind, dt, params, work, forces_moments):
+    """
+    advances the flat 13 state in place by one time step of size dt: the air data are computed
+    from the state and wind, then the forces and moments, then one RK4 step (see _rk4_step)
+    :param delta: flat 4 vector (delta_e, delta_a, delta_r, delta_t), see _delta_to_array
+    :param wind: flat 6 vector, steady wind in the inertial frame followed by gust in the body frame
+    :param forces_moments: flat 6 output vector, the forces and moments held over the step
+    :return: (Va, alpha, beta) at the new state
+    """
+    Va, alpha, beta = _update_velocity_kernel(state, wind)
+    fx, fy, fz, Mx, My, Mz = _forces_moments_kernel(state, delta, Va, alpha, beta, params)
+    forces_moments[0] = fx
+    forces_moments[1] = fy
+    forces_moments[2] = fz
+    forces_moments[3] = Mx
+    forces_moments[4] = My
+    forces_moments[5] = Mz
+    _rk4_step(state, forces_moments, dt, params, work)
+    return _update_velocity_kernel(state, wind)
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _simulate_batch_kernel(states, deltas, winds, dt, params, history):
+    """
+    propagates N independent vehicles for T time steps, in parallel over the vehicles
+    :param states: (N, 13) initial states, advanced in place to the final states
+    :param deltas: (T, N, 4) control inputs at each time step, see _delta_to_array
+    :param winds: (T, N, 6) wind at each time step, see _update_velocity_kernel
+    :param history: (T, N, 13) output, the states after each time step
+    """
+    num_steps = deltas.shape[0]
+    for i in prange(states.shape[0]):
+        work = np.empty((5, 13), dtype=states.dtype)
+        forces_moments = np.empty(6, dtype=states.dtype)
+        for t in range(num_steps):
+            _simulate_one_tick(states[i], deltas[t, i], winds[t, i], dt, params, work, forces_moments)
+            history[t, i] = states[i]
+
+
+@njit(cache=True, fastmath=True)
+def _update_batch_kernel(states, deltas, winds, dt, params, work, forces_moments, outputs):
+    """
+    advances N vehicles in place by one time step, each with _simulate_one_tick
+    :param states: (N, 13) states, one row per vehicle
+    :param deltas: (N, 4) control inputs, see _delta_to_array
+    :param winds: (N, 6) wind vectors, see _update_velocity_kernel
+    :param work: (5, 13) scratch buffer for the RK4 stages, reused for every vehicle
+    :param forces_moments: (N, 6) output, the forces and moments held over the step
+    :param outputs: (N, 9) output, (Va, alpha, beta, phi, theta, psi, Vg, gamma, chi)
+        at the new states
+    """
+    for j in range(states.shape[0]):
+        state = states[j]
+        Va, alpha, beta = _simulate_one_tick(state, deltas[j], winds[j], dt, params, work,
+                                             forces_moments[j])
+        e0 = state[6]
+        e1 = state[7]
+        e2 = state[8]
+        e3 = state[9]
+        phi, theta, psi = _quat_to_euler(e0, e1, e2, e3)
+        pn_dot, pe_dot, pd_dot = _quat_rotate(e0, e1, e2, e3, state[3], state[4], state[5])
+        Vg = math.sqrt(pn_dot*pn_dot + pe_dot*pe_dot + pd_dot*pd_dot)
+        outputs[j, 0] = Va
+        outputs[j, 1] = alpha
+        outputs[j, 2] = beta
+        outputs[j, 3] = phi
+        outputs[j, 4] = theta
+        outputs[j, 5] = psi
+        outputs[j, 6] = Vg
+        outputs[j, 7] = math.asin(pd_dot/Vg) if Vg > 0 else 0.0
+        outputs[j, 8] = math.atan2(pe_dot, pn_dot)
 
 
 class MavDynamics:
-    def __init__(self, Ts):
+    def __init__(self, Ts, dtype=np.float64):
         self._ts_simulation = Ts
+        # floating point type of the propagated state and of the constants used to propagate it.
+        # float32 halves the memory traffic of large ensembles; float64 is the default
+        self._dtype = np.dtype(dtype)
         # set initial states based on parameter file
-        # _state is the 13x1 internal state of the aircraft that is being propagated:
+        # _state is the 13 element internal state of the aircraft that is being propagated:
         # _state = [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
         # We will also need a variety of other elements that are functions of the _state and the wind.
         # self.true_state is a 19x1 vector that is estimated and used by the autopilot to control the aircraft:
         # true_state = [pn, pe, h, Va, alpha, beta, phi, theta, chi, p, q, r, Vg, wn, we, psi, gyro_bx, gyro_by, gyro_bz]
-        self._state = np.array([[MAV.north0],  # (0)
-                               [MAV.east0],   # (1)
-                               [MAV.down0],   # (2)
-                               [MAV.u0],    # (3)
-                               [MAV.v0],    # (4)
-                               [MAV.w0],    # (5)
-                               [MAV.e0],    # (6)
-                               [MAV.e1],    # (7)
-                               [MAV.e2],    # (8)
-                               [MAV.e3],    # (9)
-                               [MAV.p0],    # (10)
-                               [MAV.q0],    # (11)
-                               [MAV.r0]])   # (12)
+        self._state = np.array([MAV.north0,  # (0)
+                                MAV.east0,   # (1)
+                                MAV.down0,   # (2)
+                                MAV.u0,    # (3)
+                                MAV.v0,    # (4)
+                                MAV.w0,    # (5)
+                                MAV.e0,    # (6)
+                                MAV.e1,    # (7)
+                                MAV.e2,    # (8)
+                                MAV.e3,    # (9)
+                                MAV.p0,    # (10)
+                                MAV.q0,    # (11)
+                                MAV.r0],   # (12)
+                               dtype=self._dtype)
+        # airframe constants used by the compiled dynamics
+        self._params = _mav_params().astype(self._dtype)
+        # scratch buffers for the RK4 stages and the forces and moments, reused every time step
+        self._rk4_work = np.empty((5, 13), dtype=self._dtype)
+        self._forces_moments_buf = np.empty(6, dtype=self._dtype)
         # store wind data for fast recall since it is used at various points in simulation
         self._wind = np.array([[0.], [0.], [0.]])  # wind in NED frame in meters/sec
         self._update_velocity_data()
@@ -49,6 +515,8 @@ class MavDynamics:
         self._Va = MAV.u0
         self._alpha = 0
         self._beta = 0
+        # attitude derived from the quaternion, refreshed once per time step
+        self._update_attitude()
         # initialize true_state message
         self.true_state = MsgState()
         # peform unit test for _update_velocity_data() function
@@ -63,230 +531,157 @@ class MavDynamics:
             wind is the wind vector in inertial coordinates
             Ts is the time step between function calls.
         """
-        # get forces and moments acting on rigid bod
-        forces_moments = self._forces_moments(delta)
-
-        # Integrate ODE using Runge-Kutta RK4 algorithm
-        time_step = self._ts_simulation
-        k1 = self._derivatives(self._state, forces_moments)
-        k2 = self._derivatives(self._state + time_step/2.*k1, forces_moments)
-        k3 = self._derivatives(self._state + time_step/2.*k2, forces_moments)
-        k4 = self._derivatives(self._state + time_step*k3, forces_moments)
-        self._state += time_step/6 * (k1 + 2*k2 + 2*k3 + k4)
-
-        # normalize the quaternion
-        e0 = self._state.item(6)
-        e1 = self._state.item(7)
-        e2 = self._state.item(8)
-        e3 = self._state.item(9)
-        normE = np.sqrt(e0**2+e1**2+e2**2+e3**2)
-        self._state[6][0] = self._state.item(6)/normE
-        self._state[7][0] = self._state.item(7)/normE
-        self._state[8][0] = self._state.item(8)/normE
-        self._state[9][0] = self._state.item(9)/normE
-
-        # update the airspeed, angle of attack, and side slip angles using new state
-        self._update_velocity_data(wind)
+        # get forces and moments acting on rigid body, integrate ODE using Runge-Kutta RK4
+        # algorithm and update the airspeed, angle of attack, and side slip angles using new state
+        # (a single compiled kernel updates the state in place)
+        self._Va, self._alpha, self._beta = _simulate_one_tick(
+            self._state, _delta_to_array(delta), wind.reshape(6), self._ts_simulation,
+            self._params, self._rk4_work, self._forces_moments_buf)
+        self._forces[:, 0] = self._forces_moments_buf[0:3]
+
+        # update the Euler angles using the new quaternion
+        self._update_attitude()
 
         # update the message class for the true state
         self._update_true_state()
 
+    @staticmethod
+    def update_batch(vehicles, deltas, winds):
+        """
+            Integrate several vehicles sharing the same airframe, time step and dtype in one call.
+            The states are packed as an (N, 13) array and every vehicle is advanced with the same
+            compiled tick as update(), in a single kernel call.
+            vehicles, deltas and winds are equal length sequences, as in update()
+        """
+        num = len(vehicles)
+        if len(deltas) != num or len(winds) != num:
+            raise ValueError('update_batch got %d vehicles, %d deltas and %d winds'
+                             % (num, len(deltas), len(winds)))
+        if num == 0:
+            return
+        dtype = vehicles[0]._dtype
+        if any(mav._dtype != dtype for mav in vehicles):
+            raise ValueError('update_batch requires all vehicles to use the same dtype')
+        ts_simulation = vehicles[0]._ts_simulation
+        if any(mav._ts_simulation != ts_simulation for mav in vehicles):
+            raise ValueError('update_batch requires all vehicles to use the same time step')
+        states = np.empty((num, 13), dtype=dtype)
+        for j, mav in enumerate(vehicles):
+            states[j] = mav._state
+        delta_array = np.array([_delta_to_array(delta) for delta in deltas])
+        wind_array = np.array([np.reshape(wind, 6) for wind in winds], dtype=np.float64)
+        forces_moments = np.empty((num, 6), dtype=dtype)
+        outputs = np.empty((num, 9))
+
+        _update_batch_kernel(states, delta_array, wind_array, ts_simulation,
+                             vehicles[0]._params, np.empty((5, 13), dtype=dtype),
+                             forces_moments, outputs)
+
+        # copy back with python floats, which is much cheaper than per element numpy indexing
+        for mav, state, out, forces in zip(vehicles, states, outputs.tolist(), forces_moments[:, 0:3]):
+            mav._state[:] = state
+            mav._forces[:, 0] = forces
+            mav._Va, mav._alpha, mav._beta, mav._phi, mav._theta, mav._psi, Vg, gamma, chi = out
+            mav._set_true_state(Vg, gamma, chi)
+
+    def simulate_batch(self, initial_states, deltas, winds):
+        """
+            Propagate an ensemble of vehicles with this airframe and time step, for example
+            for Monte Carlo runs, using one thread per vehicle.
+            initial_states is (N, 13), deltas is (T, N, 4) in the _delta_to_array order and
+            winds is (T, N, 6) as in update(). Returns the (T, N, 13) state history.
+            The state of this vehicle is not changed.
+        """
+        states = np.array(initial_states, dtype=self._dtype, order='C')
+        deltas = np.ascontiguousarray(deltas, dtype=np.float64)
+        winds = np.ascontiguousarray(winds, dtype=np.float64)
+        # the compiled kernel does not check bounds, so reject mismatched shapes here
+        if states.ndim != 2 or states.shape[1] != 13:
+            raise ValueError('initial_states must have shape (N, 13), got %s' % (states.shape,))
+        num_vehicles = states.shape[0]
+        if deltas.ndim != 3 or deltas.shape[1:] != (num_vehicles, 4):
+            raise ValueError('deltas must have shape (T, %d, 4), got %s' % (num_vehicles, deltas.shape))
+        if winds.shape != (deltas.shape[0], num_vehicles, 6):
+            raise ValueError('winds must have shape %s, got %s'
+                             % ((deltas.shape[0], num_vehicles, 6), winds.shape))
+        history = np.empty((deltas.shape[0],) + states.shape, dtype=self._dtype)
+        _simulate_batch_kernel(states, deltas, winds, self._ts_simulation, self._params, history)
+        return history
+
     def external_set_state(self, new_state):
-        self._state = new_state
+        # accepts either the flat 13 state or the legacy 13x1 column
+        self._state = np.ascontiguousarray(new_state, dtype=self._dtype).reshape(13)
+        self._update_attitude()
+
+    @property
+    def state_col(self):
+        """
+        the internal state as a 13x1 column, for code written against the old layout
+        """
+        return self._state.reshape((13, 1))
 
     ###################################
     # private functions
-    def _derivatives(self, state, forces_moments):
+    def _update_attitude(self):
         """
-        for the dynamics xdot = f(x, u), returns f(x, u)
+        cache the Euler angles of the current quaternion
+        """
+        self._phi, self._theta, self._psi = _quat_to_euler(*self._state[6:10])
+
+    def _update_velocity_data(self, wind=None):
         """
-        # extract the states
-        # north = state.item(0)
-        # east = state.item(1)
-        # down = state.item(2)
-        u = state.item(3)
-        v = state.item(4)
-        w = state.item(5)
-        e0 = state.item(6)
-        e1 = state.item(7)
-        e2 = state.item(8)
-        e3 = state.item(9)
-        p = state.item(10)
-        q = state.item(11)
-        r = state.item(12)
-        #   extract forces/moments
-        fx = forces_moments.item(0)
-        fy = forces_moments.item(1)
-        fz = forces_moments.item(2)
-        l = forces_moments.item(3)
-        m = forces_moments.item(4)
-        n = forces_moments.item(5)
-
-        # position kinematics
-        quaternion = np.array([e0, e1, e2, e3])
-        Rb_i = Quaternion2Rotation(quaternion)
-        
-        pos_dot = Rb_i @ np.array([u, v, w]).T
-        
-        north_dot = pos_dot[0]
-        east_dot = pos_dot[1]
-        down_dot = pos_dot[2]
-
-        # position dynamics
-        u_dot = (r*v - q*w) + (1/MAV.mass)*fx
-        v_dot = (p*w - r*u) + (1/MAV.mass)*fy
-        w_dot = (q*u - p*v) + (1/MAV.mass)*fz
-
-        # rotational kinematics
-        skew_sym = np.array([
-            [0, -p, -q, -r],
-            [p,  0,  r, -q],
-            [q, -r,  0,  p],
-            [r,  q, -p,  0],
-        ])
-
-        e_dot = 0.5 * skew_sym @ quaternion.T
-        e0_dot = e_dot.item(0)
-        e1_dot = e_dot.item(1)
-        e2_dot = e_dot.item(2)
-        e3_dot = e_dot.item(3)
-
-        # rotatonal dynamics
-        p_dot = MAV.gamma1*p*q - MAV.gamma2*q*r + MAV.gamma3*l + MAV.gamma4*n
-        q_dot = MAV.gamma5*p*r - MAV.gamma6*(p**2 - r**2) + (1/MAV.Jy)*m
-        r_dot = MAV.gamma7*p*q - MAV.gamma1*q*r + MAV.gamma4*l + MAV.gamma8*n
-
-        # collect the derivative of the states
-        x_dot = np.array([[north_dot, east_dot, down_dot, u_dot, v_dot, w_dot,
-                           e0_dot, e1_dot, e2_dot, e3_dot, p_dot, q_dot, r_dot]]).T
-        return x_dot
-
-    def _update_velocity_data(self, wind=np.zeros((6,1))):
-        steady_state = wind[0:3]
-        gust = wind[3:6]
-        # convert wind vector from world to body frame and add gust
-        Rb_i = Quaternion2Rotation(self._state[6:10])
-        wind_body_frame = Rb_i @ steady_state + gust
-        # velocity vector relative to the airmass
-        v_air = self._state[3:6] - wind_body_frame
-        ur = v_air.item(0)
-        vr = v_air.item(1)
-        wr = v_air.item(2)
-        # compute airspeed
-        self._Va = np.linalg.norm(v_air)
-        # compute angle of attack
-        if ur == 0:
-            self._alpha = 0
-        else:
-            self._alpha = np.arctan(wr/ur)
-        # compute sideslip angle
-        if self._Va == 0:
-            self._beta = 0
-        else:
-            self._beta = np.arcsin(vr/self._Va)
-
-    def _forces_moments(self, delta):
+        update the airspeed, angle of attack and sideslip angle from the current state
+        :param wind: flat 6 vector, steady wind in the inertial frame followed by gust in the body frame,
+            or None for calm air
+        """
+        if wind is None:
+            wind = _NO_WIND
+        self._Va, self._alpha, self._beta = _update_velocity_kernel(self._state, wind)
+
+    def _forces_moments(self, state, delta):
         """
         return the forces on the UAV based on the state, wind, and control surfaces
-        :param delta: np.matrix(delta_a, delta_e, delta_r, delta_t)
-        :return: Forces and Moments on the UAV np.matrix(Fx, Fy, Fz, Ml, Mn, Mm)
+        :param state: flat 13 state [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
+        :param delta: flat 4 vector (delta_e, delta_a, delta_r, delta_t), see _delta_to_array
+        :return: Forces and Moments on the UAV np.array(Fx, Fy, Fz, Ml, Mn, Mm)
         """
-        phi, theta, psi = Quaternion2Euler(self._state[6:10])
-        p = self._state.item(10)
-        q = self._state.item(11)
-        r = self._state.item(12)
-
-        # Sigma --> Blending Function
-        sigma_num = (1 + np.exp(-MAV.M*(self._alpha - MAV.alpha0)) + np.exp(MAV.M*(self._alpha + MAV.alpha0))) 
-        sigma_denom = (1 + np.exp(-MAV.M*(self._alpha - MAV.alpha0))) * (1 + np.exp(MAV.M*(self._alpha + MAV.alpha0)))
-        sigma = sigma_num / sigma_denom
-
-        # compute gravitaional forces
-        Rb_i = Quaternion2Rotation(self._state[6:10])
-        f_g = Rb_i*np.array([
-                            [0],
-                            [0],
-                            [MAV.mass*MAV.gravity],
-                            ])
-
-        # compute Lift and Drag coefficients
-        CL = ((1 - sigma)*(MAV.C_L_0 + MAV.C_L_alpha*self._alpha)) + ((sigma)*2*np.sign(self._alpha)*(np.sin(self._alpha)**2)*np.cos(self._alpha))
-        CD = MAV.C_D_p + ((MAV.C_L_0 + MAV.C_L_alpha*self._alpha)**2)/(np.pi*MAV.e*MAV.AR)
-
-        # compute Lift and Drag Forces
-        q_dynamic = 0.5*MAV.rho*(self._Va**2)*MAV.S_wing        # dynamic pressure --> force term (*S) for lift/drag
-        F_lift = q_dynamic*(CL * (MAV.C_L_q*0.5*MAV.c/self._Va*q) + MAV.C_L_delta_e*delta.elevator)
-        F_drag = q_dynamic*(CD * (MAV.C_D_q*0.5*MAV.c/self._Va*q) + MAV.C_D_delta_e*delta.elevator)
-
-        #compute propeller thrust and torque
-        thrust_prop, torque_prop = self._motor_thrust_torque(self._Va, delta.throttle)
-
-        # compute longitudinal forces in body frame
-        fx = -F_drag*np.cos(self._alpha) + F_lift*np.sin(self._alpha)
-        fz = -F_drag*np.sin(self._alpha) - F_lift*np.cos(self._alpha)
-
-        # compute lateral forces in body frame
-        fy = q_dynamic * (MAV.C_Y_0 + MAV.C_Y_beta*self._beta + MAV.C_Y_p*0.5*MAV.b*p/self._Va + MAV.C_Y_r*0.5*MAV.b*r/self._Va + MAV.C_Y_delta_a*delta.aileron + MAV.C_Y_delta_r*delta.rudder) 
-
-        # compute logitudinal torque in body frame
-        My = q_dynamic*MAV.c*(MAV.C_m_0 + (MAV.C_m_alpha*self._alpha) + (MAV.C_m_q*MAV.c*0.5*q/self._Va) + (MAV.C_m_delta_e*delta.elevator))
-       
-        # compute lateral torques in body frame
-        Mx = q_dynamic*MAV.b*(MAV.C_ell_0 + MAV.C_ell_beta*self._beta + MAV.C_ell_p*0.5*MAV.b*r/self._Va + MAV.C_ell_delta_a*delta.aileron + MAV.C_ell_delta_r*delta.rudder)
-        Mz = q_dynamic*MAV.b*(MAV.C_n_0 + MAV.C_n_beta*self._beta + MAV.C_n_p*0.5*MAV.b*r/self._Va + MAV.C_n_delta_a*delta.aileron + MAV.C_n_delta_r*delta.rudder)
-
-        self._forces[0] = fx
-        self._forces[1] = fy
-        self._forces[2] = fz
-        return np.array([[fx, fy, fz, Mx, My, Mz]]).T
+        forces_moments = np.array(_forces_moments_kernel(state, delta, self._Va, self._alpha,
+                                                         self._beta, self._params),
+                                  dtype=self._dtype)
+        self._forces[:, 0] = forces_moments[0:3]
+        return forces_moments
 
     def _motor_thrust_torque(self, Va, delta_t):
         # compute thrust and torque due to propeller  (See addendum by McLain)
-
-        # map delta_t throttle command(0 to 1) into motor input voltage
-        V_in = MAV.V_max * delta_t
-
-        # quadratic formula to solve for motor speed
-        a = MAV.C_Q0 * MAV.rho * np.power(MAV.D_prop, 5) / ((2*np.pi)**2)
-        b = (MAV.C_Q1 * MAV.rho * np.power(MAV.D_prop, 4) * Va / ((2*np.pi)**2)) + (MAV.KQ**2)/MAV.R_motor
-        c = (MAV.C_Q2 * MAV.rho * np.power(MAV.D_prop, 3) * Va**2) - (MAV.KQ/MAV.R_motor) + MAV.KQ*MAV.i0
-
-        # operating propeller speed
-        Omega_op = (-b + np.sqrt(b**2 - 4*a*c)) / (2.*a) # rad/sec
-        # compute advance ratio
-        J_op = 2 * np.pi * Va / (Omega_op * MAV.D_prop)
-
-        # thrust and torque coefficients
-        C_T = MAV.C_T2 * J_op**2 + MAV.C_T1 * J_op + MAV.C_T0
-        C_Q = MAV.C_Q2 * J_op**2 + MAV.C_Q1 * J_op + MAV.C_Q0
-
-        n = Omega_op / (2 * np.pi)  # rev/sec
-
-        # thrust and torque due to propeller
-        thrust_prop = MAV.rho * n**2 * np.power(MAV.D_prop, 4) * C_T
-        torque_prop = MAV.rho * n**2 * np.power(MAV.D_prop, 5) * C_Q
-        return thrust_prop, torque_prop
+        return _motor_thrust_torque_kernel(Va, delta_t, self._params)
 
     def _update_true_state(self):
         # update the class structure for the true state:
         #   [pn, pe, h, Va, alpha, beta, phi, theta, chi, p, q, r, Vg, wn, we, psi, gyro_bx, gyro_by, gyro_bz]
-        phi, theta, psi = Quaternion2Euler(self._state[6:10])
-        pdot = Quaternion2Rotation(self._state[6:10]) @ self._state[3:6]
-        self.true_state.north = self._state.item(0)
-        self.true_state.east = self._state.item(1)
-        self.true_state.altitude = -self._state.item(2)
+        pn_dot, pe_dot, pd_dot = _quat_rotate(*self._state[6:10], *self._state[3:6])
+        Vg = math.sqrt(pn_dot*pn_dot + pe_dot*pe_dot + pd_dot*pd_dot)
+        gamma = math.asin(pd_dot / Vg) if Vg > 0 else 0.0
+        chi = math.atan2(pe_dot, pn_dot)
+        self._set_true_state(Vg, gamma, chi)
+
+    def _set_true_state(self, Vg, gamma, chi):
+        # fill the true state message from the state, the cached air data and attitude,
+        # and the ground speed Vg, flight path angle gamma and course chi
+        self.true_state.north = self._state[0]
+        self.true_state.east = self._state[1]
+        self.true_state.altitude = -self._state[2]
         self.true_state.Va = self._Va
         self.true_state.alpha = self._alpha
         self.true_state.beta = self._beta
-        self.true_state.phi = phi
-        self.true_state.theta = theta
-        self.true_state.psi = psi
-        self.true_state.Vg = np.linalg.norm(pdot)
-        self.true_state.gamma = np.arcsin(pdot.item(2) / self.true_state.Vg)
-        self.true_state.chi = np.arctan2(pdot.item(1), pdot.item(0))
-        self.true_state.p = self._state.item(10)
-        self.true_state.q = self._state.item(11)
-        self.true_state.r = self._state.item(12)
+        self.true_state.phi = self._phi
+        self.true_state.theta = self._theta
+        self.true_state.psi = self._psi
+        self.true_state.Vg = Vg
+        self.true_state.gamma = gamma
+        self.true_state.chi = chi
+        self.true_state.p = self._state[10]
+        self.true_state.q = self._state[11]
+        self.true_state.r = self._state[12]
         self.true_state.wn = self._wind.item(0)
         self.true_state.we = self._wind.item(1)
 
@@ -304,12 +699,13 @@ if __name__ == "__main__":
     # Input for orientation, speed, wind
     phi0, theta0, psi0 = (np.pi * 0, np.pi * 0, np.pi * 0)
     u0, v0, w0 = (0, 0, 0)
-    wind = np.array([[0.0], [0.0], [0.0], [0.0], [0.0], [0.0]])
+    wind = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
 
     def runCalc():
         # Update the mav from inputs
-        mav._state[6:10] = Euler2Quaternion(phi0, theta0, psi0)
-        mav._state[3:6] = np.array([[u0], [v0], [w0]])
+        mav._state[6:10] = Euler2Quaternion(phi0, theta0, psi0).ravel()
+        mav._state[3:6] = [u0, v0, w0]
+        mav._update_attitude()
         # Update wind conditions
         mav._update_velocity_data(wind)
         mav._update_true_state()
@@ -328,23 +724,38 @@ if __name__ == "__main__":
     runCalc()
 
     u0, v0, w0 = (0, 0, 0)
-    wind = np.array([[1.0], [0.0], [0.0], [0.0], [0.0], [0.0]])
+    wind = np.array([1.0, 0.0, 0.0, 0.0, 0.0, 0.0])
     runCalc()
 
-    wind = np.array([[1.0], [1.0], [0.0], [0.0], [0.0], [0.0]])
+    wind = np.array([1.0, 1.0, 0.0, 0.0, 0.0, 0.0])
     runCalc()
 
-    wind = np.array([[1.0], [0.0], [1.0], [0.0], [0.0], [0.0]])
+    wind = np.array([1.0, 0.0, 1.0, 0.0, 0.0, 0.0])
     runCalc()
 
     u0, v0, w0 = (1, 0, 0)
-    wind = np.array([[1.0], [0.0], [0.0], [0.0], [0.0], [0.0]])
+    wind = np.array([1.0, 0.0, 0.0, 0.0, 0.0, 0.0])
     runCalc()
 
     u0, v0, w0 = (0, 0, 0)
-    wind = np.array([[3.0], [4.0], [0.0], [0.0], [0.0], [0.0]])
+    wind = np.array([3.0, 4.0, 0.0, 0.0, 0.0, 0.0])
     runCalc()
 
     u0, v0, w0 = (0, 4, 0)
-    wind = np.array([[3.0], [4.0], [0.0], [0.0], [0.0], [0.0]])
-    runCalc()
\ No newline at end of file
+    wind = np.array([3.0, 4.0, 0.0, 0.0, 0.0, 0.0])
+    runCalc()
+
+    # Check that the batch update follows update() in a time varying wind
+    from message_types.msg_delta import MsgDelta
+    num_vehicles = 4
+    batch = [MavDynamics(Ts) for _ in range(num_vehicles)]
+    single = [MavDynamics(Ts) for _ in range(num_vehicles)]
+    deltas = [MsgDelta(elevator=-0.1 + 0.02*j, aileron=0.01*j) for j in range(num_vehicles)]
+    for k in range(200):
+        winds = [np.array([1.0 + 0.01*k, 0.5*j, 0.2, 0.1*np.sin(0.1*k), 0.0, -0.1])
+                 for j in range(num_vehicles)]
+        MavDynamics.update_batch(batch, deltas, winds)
+        for vehicle, delta, wind in zip(single, deltas, winds):
+            vehicle.update(delta, wind)
+    print('update_batch vs update:',
+          max(np.max(np.abs(a._state - b._state)) for a, b in zip(batch, single)))